@@ -1,8 +1,9 @@
 import os
-import glob
-import subprocess
+import numpy as np
 import pretty_midi
+from numba import njit
 
+from basic_pitch.inference import predict
 from basic_pitch.evaluation import score_prediction
 from basic_pitch.constants import ANNOTATION_FPS
 
@@ -32,9 +33,24 @@ CLEAN_MAX_PITCH = 108
 # -------------------
 # 2) MIDI CLEANUP (same as your backend)
 # -------------------
+@njit(cache=True)
+def _merge_same_pitch(starts, ends, pitches, velocities, merge_gap):
+    # notes sorted by (pitch, start); folds each near-touching note into the
+    # note it follows, updating that note's end/velocity in place
+    keep = np.ones(len(starts), dtype=np.bool_)
+    head = 0
+    for i in range(1, len(starts)):
+        if pitches[i] == pitches[head] and starts[i] <= ends[head] + merge_gap:
+            keep[i] = False
+            ends[head] = max(ends[head], ends[i])
+            velocities[head] = max(velocities[head], velocities[i])
+        else:
+            head = i
+    return keep
+
+
 def clean_midi(
-    in_midi_path: str,
-    out_midi_path: str,
+    pm: pretty_midi.PrettyMIDI,
     min_dur: float = 0.16,
     min_velocity: int = 30,
     merge_gap: float = 0.05,
@@ -42,100 +58,69 @@ def clean_midi(
     max_pitch: int = 108,
     legato_gap: float = 0.08,
 ):
-    pm = pretty_midi.PrettyMIDI(in_midi_path)
-
     for inst in pm.instruments:
-        notes = [
-            n for n in inst.notes
-            if (
-                min_pitch <= n.pitch <= max_pitch
-                and (n.end - n.start) >= min_dur
-                and n.velocity >= min_velocity
-            )
-        ]
+        notes = inst.notes
+        starts = np.fromiter((n.start for n in notes), float, len(notes))
+        ends = np.fromiter((n.end for n in notes), float, len(notes))
+        pitches = np.fromiter((n.pitch for n in notes), int, len(notes))
+        velocities = np.fromiter((n.velocity for n in notes), int, len(notes))
+        durations = ends - starts
+
+        keep = durations >= min_dur
+        keep &= pitches >= min_pitch
+        keep &= pitches <= max_pitch
+        keep &= velocities >= min_velocity
+        # kept indices in (pitch, start) order, so each array is gathered once
+        kept = np.flatnonzero(keep)
+        kept = kept[np.lexsort((starts[kept], pitches[kept]))]
+        starts = starts[kept]
+        ends = ends[kept]
+        pitches = pitches[kept]
+        velocities = velocities[kept]
 
         # merge same pitch notes that nearly touch
-        notes.sort(key=lambda n: (n.pitch, n.start))
-        merged = []
-        for n in notes:
-            if not merged:
-                merged.append(n)
-                continue
-            prev = merged[-1]
-            if n.pitch == prev.pitch and n.start <= prev.end + merge_gap:
-                prev.end = max(prev.end, n.end)
-                prev.velocity = max(prev.velocity, n.velocity)
-            else:
-                merged.append(n)
+        keep = _merge_same_pitch(starts, ends, pitches, velocities, merge_gap)
+        starts = starts[keep]
+        ends = ends[keep]
+        pitches = pitches[keep]
+        velocities = velocities[keep]
 
         # legato-gap fill to reduce rests in notation
-        merged.sort(key=lambda n: n.start)
-        for i in range(len(merged) - 1):
-            a = merged[i]
-            b = merged[i + 1]
-            gap = b.start - a.end
-            if 0 < gap <= legato_gap:
-                a.end = max(a.end, b.start - 0.005)
-
-        inst.notes = merged
-
-    pm.write(out_midi_path)
+        # already start-sorted within each pitch: stable (tim)sort just merges
+        # those runs, and keeps lower pitches first on equal starts
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = ends[order]
+        pitches = pitches[order]
+        velocities = velocities[order]
+        gap = starts[1:] - ends[:-1]
+        fill = (gap > 0) & (gap <= legato_gap)
+        np.maximum(ends[:-1], starts[1:] - 0.005, out=ends[:-1], where=fill)
+
+        inst.notes = [
+            pretty_midi.Note(velocity=v, pitch=p, start=s, end=e)
+            for v, p, s, e in zip(
+                velocities.tolist(), pitches.tolist(), starts.tolist(), ends.tolist()
+            )
+        ]
 
 
 # -------------------
-# 3) RUN BASIC PITCH (CLI) -> RAW MIDI
+# 3) RUN BASIC PITCH -> RAW MIDI
 # -------------------
-print("Running Basic Pitch CLI...")
+print("Running Basic Pitch...")
 
-# Use a stable stem so we can find the output
-stem = os.path.splitext(os.path.basename(AUDIO_FILE_PATH))[0]
-raw_out_pattern = os.path.join(OUT_DIR, stem + "*.mid")
-
-# Clean up old matches
-for old in glob.glob(raw_out_pattern):
-    try:
-        os.remove(old)
-    except:
-        pass
-
-command = [
-    "basic-pitch",
-    OUT_DIR,
-    "--onset-threshold", str(ONSET_THRESHOLD),
-    "--minimum-note-length", str(MIN_NOTE_DURATION_SEC),
-    "--save-midi",
+_, midi_data, _ = predict(
     AUDIO_FILE_PATH,
-]
-
-# Windows UTF-8 fix (sparkles print)
-env = os.environ.copy()
-env["PYTHONIOENCODING"] = "utf-8"
-env["PYTHONUTF8"] = "1"
-
-subprocess.run(
-    command,
-    check=True,
-    capture_output=True,
-    text=True,
-    encoding="utf-8",
-    env=env,
+    onset_threshold=ONSET_THRESHOLD,
+    minimum_note_length=MIN_NOTE_DURATION_SEC * 1000,  # predict() wants ms
 )
 
-matches = glob.glob(raw_out_pattern)
-if not matches:
-    raise RuntimeError(f"No MIDI produced. Looked for: {raw_out_pattern}")
-
-raw_midi_path = max(matches, key=os.path.getmtime)
-print("Raw MIDI:", raw_midi_path)
-
 # -------------------
 # 4) CLEAN MIDI (your pipeline)
 # -------------------
-cleaned_midi_path = os.path.join(OUT_DIR, stem + "_clean.mid")
-
 clean_midi(
-    raw_midi_path,
-    cleaned_midi_path,
+    midi_data,
     min_dur=CLEAN_MIN_DUR,
     min_velocity=CLEAN_MIN_VELOCITY,
     merge_gap=CLEAN_MERGE_GAP,
@@ -144,6 +129,9 @@ clean_midi(
     legato_gap=CLEAN_LEGATO_GAP,
 )
 
+stem = os.path.splitext(os.path.basename(AUDIO_FILE_PATH))[0]
+cleaned_midi_path = os.path.join(OUT_DIR, stem + "_clean.mid")
+midi_data.write(cleaned_midi_path)
 print("Cleaned MIDI:", cleaned_midi_path)
 
 # -------------------
@@ -1,18 +1,58 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import FileResponse
+from fastapi import BackgroundTasks, FastAPI, Request, UploadFile, File
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import multiprocessing
 import os
+import shutil
 import uuid
-import subprocess
-import glob
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 
 import librosa
 import numpy as np
 import soundfile as sf
 import pretty_midi
+from numba import njit
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    import tensorflow as tf
+
+    # inference only: grow GPU memory on demand instead of reserving all of it,
+    # and keep TF's pools small so they don't oversubscribe the request threads.
+    # Has to happen before TF initialises its runtime, i.e. before the model loads.
+    for gpu in tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.config.threading.set_intra_op_parallelism_threads(max(1, (os.cpu_count() or 2) // 2))
+except ImportError:  # basic-pitch falls back to ONNX / TFLite
+    pass
+
+from basic_pitch import ICASSP_2022_MODEL_PATH
+from basic_pitch.constants import AUDIO_N_SAMPLES, AUDIO_SAMPLE_RATE, FFT_HOP
+from basic_pitch.inference import Model, unwrap_output, window_audio_file
+from basic_pitch.note_creation import model_output_to_notes
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # pool and queue live per app run, so the app can be started again
+    app.state.basic_pitch_pool = new_basic_pitch_pool()
+    # (future, audio) pairs waiting for the next batched inference
+    app.state.basic_pitch_queue = asyncio.Queue()
+    # start the Basic Pitch worker (and load its model) before the first request
+    await asyncio.get_running_loop().run_in_executor(app.state.basic_pitch_pool, os.getpid)
+    batcher = asyncio.create_task(batch_transcriptions(app.state))
+    try:
+        yield
+    finally:
+        batcher.cancel()
+        app.state.basic_pitch_pool.shutdown()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,8 +70,14 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # --- BASIC PITCH PARAMS (clean piano defaults) ---
 ONSET_THRESHOLD = 0.60
+FRAME_THRESHOLD = 0.30
 MIN_NOTE_DURATION = 0.22
 
+# --- BASIC PITCH BATCHING (concurrent requests share one model call) ---
+BATCH_WAIT = 0.02          # seconds to wait for more requests to join a batch
+BATCH_MAX_REQUESTS = 8
+BATCH_MAX_WINDOWS = 32     # model windows per forward pass (bounds TF memory)
+
 # --- AUDIO GATE (removes quiet noise) ---
 RMS_THRESHOLD = 0.02  # try 0.01–0.04
 
@@ -46,20 +92,174 @@ CLEAN_LEGATO_GAP = 0.08    # seconds (reduces rests in notation)
 CLEAN_MIN_PITCH = 43       # <--- bumping this up usually kills the rumble notes
 CLEAN_MAX_PITCH = 80    # Default - 108
 
+# Basic Pitch runs in one dedicated worker process that loads the model once
+# and keeps it resident. Spawned (not forked) so TF starts from a clean state.
+_basic_pitch_model = None
+
+
+def _load_basic_pitch_model():
+    global _basic_pitch_model
+    _basic_pitch_model = Model(ICASSP_2022_MODEL_PATH)
+    # one dummy window so graph tracing happens here, not on the first request
+    _basic_pitch_model.predict(np.zeros((1, AUDIO_N_SAMPLES, 1), dtype=np.float32))
+
+
+def new_basic_pitch_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_load_basic_pitch_model,
+    )
+
+
+# same windowing as basic_pitch.inference.run_inference
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+
+
+def run_basic_pitch_batch(audios: list) -> list:
+    """Transcribe several 22.05 kHz mono signals, sharing model calls.
+
+    Returns one PrettyMIDI or exception per input, so a bad clip only
+    fails its own request.
+    """
+    windows = []
+    counts = []
+    for audio in audios:
+        padded = np.concatenate([np.zeros(OVERLAP_LEN // 2, dtype=np.float32), audio])
+        audio_windows = [w for w, _ in window_audio_file(padded, HOP_SIZE)]
+        windows.extend(audio_windows)
+        counts.append(len(audio_windows))
+
+    outputs = {"note": [], "onset": [], "contour": []}
+    for i in range(0, len(windows), BATCH_MAX_WINDOWS):
+        batch = np.stack(windows[i : i + BATCH_MAX_WINDOWS])
+        for k, v in _basic_pitch_model.predict(batch).items():
+            outputs[k].append(v)
+    outputs = {k: np.concatenate(v) for k, v in outputs.items()}
+
+    results = []
+    offset = 0
+    for audio, count in zip(audios, counts):
+        chunk = slice(offset, offset + count)
+        offset += count
+        try:
+            model_output = {
+                k: unwrap_output(v[chunk], len(audio), N_OVERLAPPING_FRAMES)
+                for k, v in outputs.items()
+            }
+            midi_data, _ = model_output_to_notes(
+                model_output,
+                onset_thresh=ONSET_THRESHOLD,
+                frame_thresh=FRAME_THRESHOLD,
+                min_note_len=int(np.round(MIN_NOTE_DURATION * AUDIO_SAMPLE_RATE / FFT_HOP)),
+            )
+        except Exception as e:
+            results.append(e)
+        else:
+            results.append(midi_data)
+    return results
+
+
+async def batch_transcriptions(state):
+    loop = asyncio.get_running_loop()
+    queue = state.basic_pitch_queue
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WAIT
+        while len(batch) < BATCH_MAX_REQUESTS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        futures = [f for f, _ in batch]
+        audios = [a for _, a in batch]
+        try:
+            results = await loop.run_in_executor(
+                state.basic_pitch_pool, run_basic_pitch_batch, audios
+            )
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # the worker died (e.g. OOM); fail this batch only and start a
+                # fresh worker for the next one
+                state.basic_pitch_pool.shutdown(wait=False)
+                state.basic_pitch_pool = new_basic_pitch_pool()
+            for f in futures:
+                if not f.done():
+                    f.set_exception(e)
+            continue
+
+        for f, result in zip(futures, results):
+            if f.done():
+                continue
+            if isinstance(result, Exception):
+                f.set_exception(result)
+            else:
+                f.set_result(result)
 
 
+async def transcribe_audio(state, audio: np.ndarray) -> pretty_midi.PrettyMIDI:
+    future = asyncio.get_running_loop().create_future()
+    await state.basic_pitch_queue.put((future, audio))
+    return await future
 
-def apply_loudness_gate(input_wav: str, output_wav: str, rms_threshold: float):
-    y, sr = librosa.load(input_wav, sr=None, mono=True)
-    rms = librosa.feature.rms(y=y, frame_length=2048, hop_length=512)[0]
-    rms_expanded = np.repeat(rms, 512)[: len(y)]
-    y_gated = np.where(rms_expanded >= rms_threshold, y, 0.0)
-    sf.write(output_wav, y_gated, sr)
+
+def apply_loudness_gate(input_wav: str, rms_threshold: float):
+    sr = AUDIO_SAMPLE_RATE
+    try:
+        # decode in blocks, downmixing as we go, so a long multichannel upload
+        # is never held as one full-size float array
+        with sf.SoundFile(input_wav) as src:
+            native_sr = src.samplerate
+            y = np.empty(src.frames, dtype=np.float32)
+            n = 0
+            for block in src.blocks(blocksize=2048 * 32, dtype="float32", always_2d=True):
+                if n + len(block) > len(y):  # header frame count was short
+                    y = np.concatenate([y, np.empty(max(len(y), len(block)), dtype=np.float32)])
+                y[n : n + len(block)] = block.mean(axis=1)
+                n += len(block)
+
+        # resample once, at Basic Pitch's rate, so inference never has to
+        y = librosa.resample(y[:n], orig_sr=native_sr, target_sr=sr)
+    except sf.LibsndfileError:
+        # not readable by libsndfile (m4a/aac, mp3 on older builds, ...):
+        # let librosa decode it through audioread/ffmpeg
+        y, _ = librosa.load(input_wav, sr=sr, mono=True, dtype=np.float32)
+    # centred 2048/512 frames, same framing as librosa.feature.rms
+    frames = sliding_window_view(np.pad(y, 1024), 2048)[::512]
+    rms_sq = np.einsum("ij,ij->i", frames, frames) / 2048
+    quiet = rms_sq < rms_threshold ** 2
+    # zero the 512-sample block under each quiet frame in place (no per-sample mask)
+    full = len(y) // 512
+    y[: full * 512].reshape(full, 512)[quiet[:full]] = 0.0
+    if quiet[full]:
+        y[full * 512 :] = 0.0
+    return y, sr
+
+
+@njit(cache=True)
+def _merge_same_pitch(starts, ends, pitches, velocities, merge_gap):
+    # notes sorted by (pitch, start); folds each near-touching note into the
+    # note it follows, updating that note's end/velocity in place
+    keep = np.ones(len(starts), dtype=np.bool_)
+    head = 0
+    for i in range(1, len(starts)):
+        if pitches[i] == pitches[head] and starts[i] <= ends[head] + merge_gap:
+            keep[i] = False
+            ends[head] = max(ends[head], ends[i])
+            velocities[head] = max(velocities[head], velocities[i])
+        else:
+            head = i
+    return keep
 
 
 def clean_midi(
-    in_midi_path: str,
-    out_midi_path: str,
+    pm: pretty_midi.PrettyMIDI,
     min_dur: float = 0.16,
     min_velocity: int = 30,
     merge_gap: float = 0.05,
@@ -67,101 +267,86 @@ def clean_midi(
     max_pitch: int = 108,
     legato_gap: float = 0.08,
 ):
-    pm = pretty_midi.PrettyMIDI(in_midi_path)
-
     for inst in pm.instruments:
+        notes = inst.notes
+        starts = np.fromiter((n.start for n in notes), float, len(notes))
+        ends = np.fromiter((n.end for n in notes), float, len(notes))
+        pitches = np.fromiter((n.pitch for n in notes), int, len(notes))
+        velocities = np.fromiter((n.velocity for n in notes), int, len(notes))
+        durations = ends - starts
+
         # 1) hard filter: pitch range + duration + velocity
-        notes = [
-            n for n in inst.notes
-            if (
-                min_pitch <= n.pitch <= max_pitch
-                and (n.end - n.start) >= min_dur
-                and n.velocity >= min_velocity
-            )
-        ]
+        keep = durations >= min_dur
+        keep &= pitches >= min_pitch
+        keep &= pitches <= max_pitch
+        keep &= velocities >= min_velocity
+        # kept indices in (pitch, start) order, so each array is gathered once
+        kept = np.flatnonzero(keep)
+        kept = kept[np.lexsort((starts[kept], pitches[kept]))]
+        starts = starts[kept]
+        ends = ends[kept]
+        pitches = pitches[kept]
+        velocities = velocities[kept]
 
         # 2) merge same pitch notes that nearly touch
-        notes.sort(key=lambda n: (n.pitch, n.start))
-        merged = []
-        for n in notes:
-            if not merged:
-                merged.append(n)
-                continue
-            prev = merged[-1]
-            if n.pitch == prev.pitch and n.start <= prev.end + merge_gap:
-                prev.end = max(prev.end, n.end)
-                prev.velocity = max(prev.velocity, n.velocity)
-            else:
-                merged.append(n)
+        keep = _merge_same_pitch(starts, ends, pitches, velocities, merge_gap)
+        starts = starts[keep]
+        ends = ends[keep]
+        pitches = pitches[keep]
+        velocities = velocities[keep]
 
         # 3) legato-gap fill to reduce rests in notation (no overlaps)
-        merged.sort(key=lambda n: n.start)
-        for i in range(len(merged) - 1):
-            a = merged[i]
-            b = merged[i + 1]
-            gap = b.start - a.end
-            if 0 < gap <= legato_gap:
-                a.end = max(a.end, b.start - 0.005)
+        # already start-sorted within each pitch: stable (tim)sort just merges
+        # those runs, and keeps lower pitches first on equal starts
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = ends[order]
+        pitches = pitches[order]
+        velocities = velocities[order]
+        gap = starts[1:] - ends[:-1]
+        fill = (gap > 0) & (gap <= legato_gap)
+        np.maximum(ends[:-1], starts[1:] - 0.005, out=ends[:-1], where=fill)
+
+        inst.notes = [
+            pretty_midi.Note(velocity=v, pitch=p, start=s, end=e)
+            for v, p, s, e in zip(
+                velocities.tolist(), pitches.tolist(), starts.tolist(), ends.tolist()
+            )
+        ]
 
-        inst.notes = merged
 
-    pm.write(out_midi_path)
+def _cleanup(paths: list):
+    for p in paths:
+        if p and os.path.exists(p):
+            try:
+                os.remove(p)
+            except:
+                pass
 
 
 @app.post("/transcribe")
-async def transcribe(audio: UploadFile = File(...)):
+async def transcribe(
+    request: Request, tasks: BackgroundTasks, audio: UploadFile = File(...)
+):
     input_filename = f"{uuid.uuid4()}_{audio.filename}"
     input_path = os.path.join(UPLOAD_DIR, input_filename)
+    stem = os.path.splitext(input_filename)[0]
+    cleaned_path = os.path.join(OUTPUT_DIR, stem + "_clean.mid")
 
-    gated_path = os.path.splitext(input_path)[0] + "_gated.wav"
-
-    midi_path = None
-    cleaned_path = None
+    # runs once the response (success or error) has been sent
+    tasks.add_task(_cleanup, [input_path, cleaned_path])
 
     try:
         with open(input_path, "wb") as f:
-            f.write(await audio.read())
-
-        apply_loudness_gate(input_path, gated_path, RMS_THRESHOLD)
-
-        command = [
-            "basic-pitch",
-            OUTPUT_DIR,
-            "--onset-threshold", str(ONSET_THRESHOLD),
-            "--minimum-note-length", str(MIN_NOTE_DURATION),
-            "--save-midi",
-            gated_path,
-        ]
-
-        env = os.environ.copy()
-        env["PYTHONIOENCODING"] = "utf-8"
-        env["PYTHONUTF8"] = "1"
-
-        result = subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            env=env,
-        )
+            # copy in 1 MiB chunks instead of holding the whole upload in memory
+            await asyncio.to_thread(shutil.copyfileobj, audio.file, f, 1 << 20)
 
-        stem = os.path.splitext(os.path.basename(gated_path))[0]
-        matches = glob.glob(os.path.join(OUTPUT_DIR, stem + "*.mid"))
+        y, _ = await asyncio.to_thread(apply_loudness_gate, input_path, RMS_THRESHOLD)
+        midi_data = await transcribe_audio(request.app.state, y)
 
-        if not matches:
-            return {
-                "error": "No MIDI file produced by Basic Pitch.",
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-            }
-
-        midi_path = max(matches, key=os.path.getmtime)
-
-        cleaned_path = os.path.splitext(midi_path)[0] + "_clean.mid"
-        clean_midi(
-            midi_path,
-            cleaned_path,
+        await asyncio.to_thread(
+            clean_midi,
+            midi_data,
             min_dur=CLEAN_MIN_DUR,
             min_velocity=CLEAN_MIN_VELOCITY,
             merge_gap=CLEAN_MERGE_GAP,
@@ -170,26 +355,14 @@ async def transcribe(audio: UploadFile = File(...)):
             legato_gap=CLEAN_LEGATO_GAP,
         )
 
+        await asyncio.to_thread(midi_data.write, cleaned_path)
+
         return FileResponse(
             cleaned_path,
             media_type="audio/midi",
             filename="transcribed_clean.mid",
+            background=tasks,
         )
 
-    except subprocess.CalledProcessError as e:
-        return {
-            "error": "Basic Pitch failed (CLI error).",
-            "stdout": e.stdout,
-            "stderr": e.stderr,
-        }
-
     except Exception as e:
-        return {"error": str(e)}
-
-    finally:
-        for p in [input_path, gated_path]:
-            if p and os.path.exists(p):
-                try:
-                    os.remove(p)
-                except:
-                    pass
+        return JSONResponse({"error": str(e)}, background=tasks)